@@ -1,16 +1,27 @@
 #!/usr/bin/python3
 """Wikidata Version Update Tool."""
 
-import configparser
+from __future__ import annotations
+
 import json
 import os
+import re
 import sys
 import typing
-from datetime import datetime
+import weakref
+from datetime import date
 from pathlib import Path
 
 import click
-import requests
+
+if typing.TYPE_CHECKING:
+    # requests is slow to import, so it is only loaded once the network is needed
+    import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
 
 __version__ = "0.1.0"
 
@@ -20,10 +31,84 @@ StrDict = dict[str, typing.Any]
 url = "https://www.wikidata.org/w/api.php"
 headers = {"User-Agent": "update-wikidata/0.1"}
 
+# Fixed part of a P577 (publication date) time value
+day_precision_time = {
+    "timezone": 0,
+    "before": 0,
+    "after": 0,
+    "precision": 11,  # day precision
+    "calendarmodel": "http://www.wikidata.org/entity/Q1985727",  # Gregorian calendar
+}
+
+# Item IDs have no leading zeros; ASCII digits only
+is_valid_qid = re.compile(r"Q[1-9][0-9]{0,9}").fullmatch
+
 # Config file location
 CONFIG_FILE = Path("config")
 DEFAULT_SESSION_FILE = Path.home() / ".wikidata_session.json"
 
+# CSRF tokens stay valid for the lifetime of a login, so fetch once per session
+csrf_tokens: weakref.WeakKeyDictionary[requests.Session, str] = (
+    weakref.WeakKeyDictionary()
+)
+anonymous_csrf_token = "+\\"
+
+
+def json_loads(data: bytes) -> typing.Any:
+    """Decode JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: typing.Any) -> str:
+    """Encode JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def read_bot_section(config_file_path: Path) -> dict[str, str] | None:
+    """Read the [bot] section of an INI-style config file.
+
+    Follows configparser for the parts the config file uses: values set in
+    [DEFAULT] are inherited, and indented lines continue the previous value.
+    Returns None if the file has no [bot] section.
+    """
+    sections: dict[str, dict[str, str]] = {}
+    values: dict[str, str] | None = None
+    key: str | None = None
+    key_indent = 0
+    for raw_line in config_file_path.read_text().splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith(("#", ";")):
+            continue
+
+        indent = len(raw_line) - len(raw_line.lstrip())
+        if values is not None and key is not None and indent > key_indent:
+            values[key] += "\n" + line
+            continue
+
+        if line.startswith("[") and line.endswith("]"):
+            values = sections.setdefault(line[1:-1], {})
+            key = None
+            continue
+        if values is None:
+            raise ValueError(f"Line before first section header: {line!r}")
+
+        # Split on the first '=' or ':', as configparser does
+        delimiters = [i for i in (line.find("="), line.find(":")) if i != -1]
+        if not delimiters:
+            raise ValueError(f"Invalid line in config file: {line!r}")
+        pos = min(delimiters)
+        key = line[:pos].strip().lower()
+        key_indent = indent
+        values[key] = line[pos + 1 :].strip()
+
+    if "bot" not in sections:
+        return None
+    return sections.get("DEFAULT", {}) | sections["bot"]
+
 
 def load_config(
     username: str | None = None,
@@ -38,45 +123,40 @@ def load_config(
     2. WIKIDATA_CONFIG_FILE environment variable
     3. Default 'config' file in current directory
     """
-    # If both username and password provided via command line, use them
+    # Command line credentials win, then environment variables; the config
+    # file is only read when neither supplies both username and password
     if username and password:
-        result = {
-            "bot_username": username,
-            "bot_password": password,
-        }
-        if session_file:
-            result["session_file"] = session_file
-        return result
+        credentials = (username, password)
+    else:
+        environ = os.environ
+        env_username = environ.get("WIKIDATA_BOT_USERNAME")
+        env_password = environ.get("WIKIDATA_BOT_PASSWORD")
+        if not (env_username and env_password):
+            return load_config_file(session_file, config_file)
 
-    # Try environment variables first
-    env_username = os.getenv("WIKIDATA_BOT_USERNAME")
-    env_password = os.getenv("WIKIDATA_BOT_PASSWORD")
+        credentials = (env_username, env_password)
+        session_file = session_file or environ.get("WIKIDATA_SESSION_FILE")
 
-    if env_username and env_password:
-        result = {
-            "bot_username": env_username,
-            "bot_password": env_password,
-        }
-        # Check for session file in environment
-        env_session_file = session_file or os.getenv("WIKIDATA_SESSION_FILE")
-        if env_session_file:
-            result["session_file"] = env_session_file
-        return result
+    result = {"bot_username": credentials[0], "bot_password": credentials[1]}
+    if session_file:
+        result["session_file"] = session_file
+    return result
 
-    # Fall back to config file
+
+def load_config_file(
+    session_file: str | None = None, config_file: str | None = None
+) -> dict[str, str]:
+    """Load bot credentials from the [bot] section of the config file."""
     try:
         # Determine config file path
         config_file_path = Path(
             config_file or os.getenv("WIKIDATA_CONFIG_FILE") or CONFIG_FILE
         )
 
-        config = configparser.ConfigParser()
-        config.read(config_file_path)
-
-        if "bot" not in config:
+        bot_section = read_bot_section(config_file_path)
+        if bot_section is None:
             raise ValueError("Config must contain [bot] section")
 
-        bot_section = config["bot"]
         if "username" not in bot_section or "password" not in bot_section:
             raise ValueError("[bot] section must contain 'username' and 'password'")
 
@@ -116,31 +196,64 @@ def load_config(
         print("- Environment: export WIKIDATA_SESSION_FILE=/path/to/session.json")
         print("- Config file: session_file = /path/to/session.json")
         sys.exit(1)
-    except (configparser.Error, ValueError) as e:
+    except (OSError, ValueError) as e:
         print(f"Error reading config file {config_file_path}: {e}")
         sys.exit(1)
 
 
 def save_session(session_data: StrDict, session_file_path: Path) -> None:
     """Save session data to file."""
-    with open(session_file_path, "w") as f:
-        json.dump(session_data, f, indent=2)
-    session_file_path.chmod(0o600)
+    if orjson is not None:
+        data = orjson.dumps(session_data, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(session_data, indent=2).encode()
+
+    # Restrict permissions before writing so the cookies are never world-readable
+    fd = os.open(session_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        # os.fchmod is missing on Windows before Python 3.13
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, 0o600)
+        else:
+            session_file_path.chmod(0o600)
+        f.write(data)
 
 
 def load_session(session_file_path: Path) -> StrDict | None:
     """Load session data from file."""
     try:
-        if session_file_path.exists():
-            with open(session_file_path, "r") as f:
-                result = json.load(f)
-                if isinstance(result, dict):
-                    return result
+        with open(session_file_path, "rb") as f:
+            result = json_loads(f.read())
     except (json.JSONDecodeError, FileNotFoundError):
-        pass
+        return None
+    if isinstance(result, dict):
+        return result
     return None
 
 
+def new_session() -> requests.Session:
+    """Create a session that reuses one connection pool for all API calls."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.headers.update(headers)
+
+    # Retries only apply to idempotent methods, so edits are never repeated
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
 def get_login_token(session: requests.Session) -> str:
     """Get a login token from the API."""
     data = wikidata_get(session, action="query", meta="tokens", type="login")
@@ -153,8 +266,7 @@ def get_login_token(session: requests.Session) -> str:
 
 def login_with_bot_password(username: str, password: str) -> requests.Session:
     """Login using bot password and return authenticated session."""
-    session = requests.Session()
-    session.headers.update(headers)
+    session = new_session()
 
     # Get login token
     login_token = get_login_token(session)
@@ -170,7 +282,7 @@ def login_with_bot_password(username: str, password: str) -> requests.Session:
 
     response = session.post(url, data=login_data)
     response.raise_for_status()
-    data = response.json()
+    data = json_loads(response.content)
 
     if "error" in data:
         raise ValueError(f"Login failed: {data['error']}")
@@ -190,6 +302,8 @@ def get_authenticated_session(
     config_file: str | None = None,
 ) -> requests.Session:
     """Get an authenticated session."""
+    import requests
+
     config = load_config(username, password, session_file, config_file)
 
     # Determine session file path
@@ -199,18 +313,22 @@ def get_authenticated_session(
     session_data = load_session(session_file_path)
     if session_data:
         print("Found existing session, testing...")
-        session = requests.Session()
-        session.headers.update(headers)
+        session = new_session()
         session.cookies.update(session_data.get("cookies", {}))
 
         try:
-            data = wikidata_get(session, action="query", meta="userinfo")
-            if "query" in data and "userinfo" in data["query"]:
-                user = data["query"]["userinfo"]
-                if user.get("name") and user.get("name") != "":
-                    print(f"Session valid! Logged in as: {user.get('name')}")
-                    return session
-        except (requests.RequestException, ValueError):
+            # Fetching the CSRF token checks the session and warms the token cache
+            data = wikidata_get(
+                session, action="query", meta="tokens|userinfo", type="csrf"
+            )
+            token = data["query"]["tokens"]["csrftoken"]
+            user = data["query"]["userinfo"]
+            # Logged out sessions get the anonymous token, which is just "+\"
+            if isinstance(token, str) and token != anonymous_csrf_token:
+                csrf_tokens[session] = token
+                print(f"Session valid! Logged in as: {user.get('name')}")
+                return session
+        except (requests.RequestException, KeyError, ValueError):
             pass
 
         print("Existing session invalid, logging in again...")
@@ -229,12 +347,14 @@ def get_authenticated_session(
 
 def wikidata_get(session: requests.Session, **kwargs: typing.Any) -> StrDict:
     """Make authenticated GET request to Wikidata API."""
-    params: dict[str, typing.Any] = {"format": "json", "formatversion": 2} | kwargs
+    # kwargs is already a fresh dict, so add the defaults in place
+    kwargs.setdefault("format", "json")
+    kwargs.setdefault("formatversion", 2)
 
-    r = session.get(url, params=params)
+    r = session.get(url, params=kwargs)
 
     try:
-        data = r.json()
+        data = json_loads(r.content)
     except json.JSONDecodeError:
         print("Failed to parse JSON response:")
         print(r.text)
@@ -244,19 +364,18 @@ def wikidata_get(session: requests.Session, **kwargs: typing.Any) -> StrDict:
         print(f"API Error: {data['error']}")
         raise ValueError(f"Wikidata API error: {data['error']}")
 
-    if isinstance(data, dict):
-        return data
-    raise ValueError("Invalid response type from API")
+    return typing.cast(StrDict, data)
 
 
 def wikidata_post(session: requests.Session, **kwargs: typing.Any) -> StrDict:
     """Make authenticated POST request to Wikidata API."""
-    params = {"format": "json", "formatversion": 2} | kwargs
+    kwargs.setdefault("format", "json")
+    kwargs.setdefault("formatversion", 2)
 
-    r = session.post(url, data=params)
+    r = session.post(url, data=kwargs)
 
     try:
-        data = r.json()
+        data = json_loads(r.content)
     except json.JSONDecodeError:
         print("Failed to parse JSON response:")
         print(r.text)
@@ -266,127 +385,143 @@ def wikidata_post(session: requests.Session, **kwargs: typing.Any) -> StrDict:
         print(f"API Error: {data['error']}")
         raise ValueError(f"Wikidata API error: {data['error']}")
 
-    if isinstance(data, dict):
-        return data
-    raise ValueError("Invalid response type from API")
+    return typing.cast(StrDict, data)
 
 
-def get_entity(session: requests.Session, qid: str) -> StrDict:
-    data = wikidata_get(session, action="wbgetentities", ids=qid)
+def get_entity(
+    session: requests.Session, qid: str, props: str | None = None
+) -> StrDict:
+    """Get an entity, optionally limited to some props (e.g. "claims")."""
+    params = {"props": props} if props else {}
+    data = wikidata_get(session, action="wbgetentities", ids=qid, **params)
     return data
 
 
-def get_version_statements(session: requests.Session, qid: str) -> list[StrDict]:
-    """Get all existing software version (P348) statements for an entity."""
-    entity_data = get_entity(session, qid)
+def get_version_statements(
+    session: requests.Session, qid: str
+) -> tuple[list[StrDict], int | None]:
+    """Get all existing software version (P348) statements for an entity.
+
+    Also returns the entity's current revision ID, so an edit based on these
+    statements can be checked for conflicts.
+    """
+    # Only claims and revision info are needed, so skip labels and sitelinks
+    entity_data = get_entity(session, qid, props="claims|info")
     entity = entity_data["entities"][qid]
+    base_revid = entity.get("lastrevid")
 
     if "claims" not in entity or "P348" not in entity["claims"]:
-        return []
+        return [], base_revid
 
     claims = entity["claims"]["P348"]
     if isinstance(claims, list):
-        return claims
-    return []
+        return claims, base_revid
+    return [], base_revid
+
+
+def new_version_claim(version: str, release_date: str) -> StrDict:
+    """Build a preferred software version claim with a release date qualifier."""
+    return {
+        "mainsnak": {
+            "snaktype": "value",
+            "property": "P348",  # software version
+            "datavalue": {"type": "string", "value": version},
+        },
+        "type": "statement",
+        "rank": "preferred",
+        "qualifiers": {
+            "P577": [  # publication date
+                {
+                    "snaktype": "value",
+                    "property": "P577",
+                    "datavalue": {
+                        "type": "time",
+                        "value": {
+                            "time": f"+{release_date}T00:00:00Z",
+                            **day_precision_time,
+                        },
+                    },
+                }
+            ]
+        },
+    }
 
 
-def downgrade_version_ranks(
-    session: requests.Session, version_statements: list[StrDict]
+def apply_version_update(
+    session: requests.Session,
+    qid: str,
+    version: str,
+    release_date: str,
+    version_statements: list[StrDict],
+    base_revid: int | None,
+    csrf_token: str,
 ) -> None:
-    """Downgrade all version statements from preferred to normal rank."""
-    csrf_token = get_csrf_token(session)
+    """Downgrade preferred version statements and add the new version in one edit.
 
+    Existing statements are sent back in full, so base_revid must be the
+    revision they were read from; Wikibase then reports an edit conflict
+    rather than overwriting changes made since.
+    """
+    claims = []
     for statement in version_statements:
         if statement.get("rank") == "preferred":
-            claim_id = statement["id"]
-            print(f"Downgrading claim {claim_id} to normal rank...")
-
-            wikidata_post(
-                session,
-                action="wbsetclaimrank",
-                claim=claim_id,
-                rank="normal",
-                token=csrf_token,
-            )
-
+            print(f"Downgrading claim {statement['id']} to normal rank...")
+            claims.append(statement | {"rank": "normal"})
 
-def add_version_statement(
-    session: requests.Session, qid: str, version: str, release_date: str
-) -> None:
-    """Add a new software version statement with preferred rank and release date qualifier."""
-    csrf_token = get_csrf_token(session)
-
-    # Create the main version claim
     print(f"Adding version {version} to {qid}...")
+    claims.append(new_version_claim(version, release_date))
 
-    data = wikidata_post(
-        session,
-        action="wbcreateclaim",
-        entity=qid,
-        property="P348",  # software version
-        snaktype="value",
-        value=json.dumps(version),
-        token=csrf_token,
-    )
-
-    claim_id = data["claim"]["id"]
-    print(f"Created claim {claim_id}")
+    params = {"baserevid": base_revid} if base_revid is not None else {}
 
-    # Set the rank to preferred
+    # Claims with an id are updated in place, the one without is created
     wikidata_post(
         session,
-        action="wbsetclaimrank",
-        claim=claim_id,
-        rank="preferred",
+        action="wbeditentity",
+        id=qid,
+        data=json_dumps({"claims": claims}),
         token=csrf_token,
+        **params,
     )
-    print("Set rank to preferred")
-
-    # Add publication date qualifier
-    wikidata_post(
-        session,
-        action="wbsetqualifier",
-        claim=claim_id,
-        property="P577",  # publication date
-        snaktype="value",
-        value=json.dumps(
-            {
-                "time": f"+{release_date}T00:00:00Z",
-                "timezone": 0,
-                "before": 0,
-                "after": 0,
-                "precision": 11,  # day precision
-                "calendarmodel": "http://www.wikidata.org/entity/Q1985727",  # Gregorian calendar
-            }
-        ),
-        token=csrf_token,
-    )
-    print("Added publication date qualifier")
 
 
 def get_csrf_token(session: requests.Session) -> str:
-    """Get a CSRF token for editing."""
+    """Get a CSRF token for editing, reusing the one already fetched for session."""
+    if session in csrf_tokens:
+        return csrf_tokens[session]
+
     data = wikidata_post(session, action="query", meta="tokens", type="csrf")
     token = data["query"]["tokens"]["csrftoken"]
     if isinstance(token, str):
+        csrf_tokens[session] = token
         return token
     raise ValueError("Invalid CSRF token type returned from API")
 
 
 def validate_qid(qid: str) -> str:
     """Validate that QID is in correct format."""
-    if not qid.startswith("Q") or not qid[1:].isdigit():
-        raise click.BadParameter("QID must be in format Q123456")
-    return qid
+    if is_valid_qid(qid):
+        return qid
+    raise click.BadParameter("QID must be in format Q123456")
 
 
 def validate_date(date_str: str) -> str:
     """Validate that date is in ISO format (YYYY-MM-DD)."""
-    try:
-        datetime.strptime(date_str, "%Y-%m-%d")
-        return date_str
-    except ValueError:
-        raise click.BadParameter("Date must be in ISO format (YYYY-MM-DD)")
+    if (
+        len(date_str) == 10
+        and date_str[4] == "-"
+        and date_str[7] == "-"
+        and date_str.isascii()
+        and date_str[:4].isdigit()
+        and date_str[5:7].isdigit()
+        and date_str[8:].isdigit()
+    ):
+        try:
+            # Rejects out of range months and days such as 2024-02-30
+            date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:]))
+            return date_str
+        except ValueError:
+            pass
+    raise click.BadParameter("Date must be in ISO format (YYYY-MM-DD)")
 
 
 @click.command()
@@ -440,7 +575,20 @@ def main(
 
         # Get existing version statements
         print("\nGetting existing version statements...")
-        version_statements = get_version_statements(session, qid)
+        if dry_run:
+            version_statements, base_revid = get_version_statements(session, qid)
+        elif session in csrf_tokens:
+            # A revalidated session already has its token, nothing to overlap
+            csrf_token = get_csrf_token(session)
+            version_statements, base_revid = get_version_statements(session, qid)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # The edit needs a CSRF token, fetch it alongside the statements
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                token_future = executor.submit(get_csrf_token, session)
+                version_statements, base_revid = get_version_statements(session, qid)
+                csrf_token = token_future.result()
 
         if version_statements:
             print(f"Found {len(version_statements)} existing version statements")
@@ -454,18 +602,21 @@ def main(
                 for stmt in preferred_versions:
                     version_val = stmt["mainsnak"]["datavalue"]["value"]
                     print(f"  - {version_val}")
-
-            if not dry_run:
-                # Downgrade existing preferred versions to normal rank
-                print("\nDowngrading previous preferred versions to normal rank...")
-                downgrade_version_ranks(session, version_statements)
         else:
             print("No existing version statements found")
 
         if not dry_run:
-            # Add new version statement with preferred rank
-            print(f"\nAdding new version statement...")
-            add_version_statement(session, qid, version, release_date)
+            # Downgrade previous preferred versions and add the new one together
+            print("\nUpdating version statements...")
+            apply_version_update(
+                session,
+                qid,
+                version,
+                release_date,
+                version_statements,
+                base_revid,
+                csrf_token,
+            )
 
             print(f"\n✅ Successfully updated {qid} with version {version}")
         else: